@@ -1,9 +1,29 @@
-﻿import discord
+﻿import asyncio
+import atexit
+import discord
 from discord.ext import commands, tasks
 import json
 import os
-from datetime import datetime, timedelta
+import time
+from bisect import bisect_right
+from collections import OrderedDict, defaultdict
+from dataclasses import asdict, dataclass, field, fields
+from functools import lru_cache
+from itertools import combinations
+from math import isqrt
+from datetime import datetime
 from dotenv import load_dotenv
+from sortedcontainers import SortedList
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Bot version
 BOT_VERSION = "0.0.9"
@@ -28,14 +48,23 @@ bot = commands.Bot(command_prefix='!', intents=INTENTS, help_command=None)
 
 # Configuration files
 CONFIG_FILE = 'config.json'
-DB_FILE = 'xp_data.json'
+
+# XP data is sharded into one file per guild so a flush only rewrites the
+# guilds that actually changed, not every user the bot has ever seen
+DATA_DIR = 'data'
+SHARD_EXT = '.msgpack' if msgpack else '.json'
+
+# Pre-sharding monolithic database files, migrated once at startup
+LEGACY_MSGPACK_FILE = 'xp_data.msgpack'
+LEGACY_JSON_FILE = 'xp_data.json'
 
 # Default XP Configuration
 DEFAULT_CONFIG = {
     'xp_per_message': 5,
     'xp_per_reaction': 5,
     'xp_per_minute_vc': 2,
-    'message_cooldown': 10
+    'message_cooldown': 10,
+    'flush_interval': 5
 }
 
 
@@ -53,31 +82,260 @@ def load_config():
         return DEFAULT_CONFIG.copy()
 
 
-# Load configuration
+@dataclass(frozen=True, slots=True)
+class Config:
+    """XP tuning knobs, frozen and slotted so hot paths read fixed struct
+    fields instead of hashing into the module's global dict"""
+    xp_per_message: int
+    xp_per_reaction: int
+    xp_per_minute_vc: int
+    message_cooldown: int
+    flush_interval: int
+
+
+# Load configuration, falling back to defaults for any missing keys
 config = load_config()
-XP_PER_MESSAGE = config.get('xp_per_message', DEFAULT_CONFIG['xp_per_message'])
-XP_PER_REACTION = config.get('xp_per_reaction', DEFAULT_CONFIG['xp_per_reaction'])
-XP_PER_MINUTE_VC = config.get('xp_per_minute_vc', DEFAULT_CONFIG['xp_per_minute_vc'])
-MESSAGE_COOLDOWN = config.get('message_cooldown', DEFAULT_CONFIG['message_cooldown'])
+CFG = Config(**{key: config.get(key, default) for key, default in DEFAULT_CONFIG.items()})
 
-# In-memory tracking
+# Cooldowns are compared as monotonic integer nanoseconds - far cheaper than
+# datetime/timedelta arithmetic on every message
+MESSAGE_COOLDOWN_NS = CFG.message_cooldown * 1_000_000_000
+
+# In-memory tracking, keyed by (guild_id, member_id) tuples - cheaper to
+# hash than building a formatted string per event. Timestamps are
+# time.monotonic() floats, immune to wall-clock/DST jumps.
 voice_join_times = {}  # Track when users join voice channels
 voice_session_starts = {}  # Track session start time for longest session calculation
-message_cooldowns = {}  # Track message cooldowns per user
+message_cooldowns = {}  # Last message time per user, in monotonic nanoseconds
+
+# Per-guild locks serializing XP mutations and flush snapshots within a
+# guild while leaving different guilds free to interleave
+_guild_locks = defaultdict(asyncio.Lock)
+
+# Authors of recently seen messages, so reactions on them never need a
+# fetch_message round-trip. Bounded LRU: oldest entry evicted past the cap.
+MSG_AUTHOR_CACHE_SIZE = 10_000
+_msg_authors = OrderedDict()  # message_id -> (author_id, author_is_bot)
+
+
+def remember_message_author(message):
+    """Record a message's author for the reaction handler's fast path"""
+    _msg_authors[message.id] = (message.author.id, message.author.bot)
+    if len(_msg_authors) > MSG_AUTHOR_CACHE_SIZE:
+        _msg_authors.popitem(last=False)
+
+@dataclass(slots=True)
+class UserData:
+    """One user's XP record - slotted, so 10k+ users don't cost a dict each"""
+    username: str = 'Unknown'
+    xp: int = 0
+    level: int = 1
+    messages: int = 0
+    reactions: int = 0
+    vc_seconds: int = 0
+    vc_partners: dict = field(default_factory=dict)  # partner_id -> {username, seconds}
+    longest_session: int = 0  # Longest single VC session in seconds
+    longest_session_date: str = None  # When the longest session occurred
+
+
+_USER_FIELDS = {f.name for f in fields(UserData)}
+
+
+def _user_from_dict(raw):
+    """Build a UserData from a stored dict, tolerating old partial records"""
+    return UserData(**{k: raw[k] for k in raw.keys() & _USER_FIELDS})
+
+
+def _loads_json(raw):
+    """Decode a JSON byte string with the fastest available parser"""
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _shard_path(guild_id):
+    return os.path.join(DATA_DIR, guild_id + SHARD_EXT)
+
+
+def _pack_users(guild_data):
+    """Snapshot a guild's UserData records as plain dicts for serialization"""
+    return {uid: asdict(user) for uid, user in guild_data.items()}
+
+
+def _write_shard(guild_id, plain, sync=False):
+    """Serialize and write one shard - safe to run off the event loop
+
+    sync=True forces the bytes to stable storage before the rename; the
+    periodic flush skips that and lets the page cache batch the writes.
+    """
+    if msgpack:
+        raw = msgpack.packb(plain, use_bin_type=True)
+    elif orjson:
+        raw = orjson.dumps(plain)
+    else:
+        # Compact separators skip the pretty-printing path, and
+        # ensure_ascii=False stops every non-ASCII username being escaped
+        raw = json.dumps(plain, separators=(',', ':'), ensure_ascii=False).encode()
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = _shard_path(guild_id)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(raw)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def save_guild(guild_id, guild_data, sync=False):
+    """Write one guild's shard to disk (atomically, via a temp file + rename)"""
+    _write_shard(guild_id, _pack_users(guild_data), sync=sync)
+
+
+def _load_legacy():
+    """Read a pre-sharding single-file database, if present
+
+    Returns (data, path) so the caller can delete the file once the
+    migrated shards are safely on disk - never before.
+    """
+    for path in (LEGACY_MSGPACK_FILE, LEGACY_JSON_FILE):
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            raw = f.read()
+        if path.endswith('.msgpack'):
+            if not msgpack:
+                continue
+            legacy = msgpack.unpackb(raw, raw=False)
+        else:
+            legacy = _loads_json(raw)
+        return legacy, path
+    return None, None
 
 
 def load_data():
-    """Load XP data from JSON file"""
-    if os.path.exists(DB_FILE):
-        with open(DB_FILE, 'r') as f:
-            return json.load(f)
-    return {}
+    """Load all guild shards, migrating any legacy monolithic database"""
+    data = {}
+    if os.path.isdir(DATA_DIR):
+        for fname in os.listdir(DATA_DIR):
+            if not fname.endswith(SHARD_EXT):
+                continue
+            guild_id = fname[:-len(SHARD_EXT)]
+            with open(os.path.join(DATA_DIR, fname), 'rb') as f:
+                raw = f.read()
+            users = msgpack.unpackb(raw, raw=False) if msgpack else _loads_json(raw)
+            data[guild_id] = {uid: _user_from_dict(u) for uid, u in users.items()}
+
+    legacy, legacy_path = _load_legacy()
+    if legacy:
+        for guild_id, users in legacy.items():
+            if guild_id not in data:
+                data[guild_id] = {uid: _user_from_dict(u) for uid, u in users.items()}
+                save_guild(guild_id, data[guild_id])
+        # Only drop the old file once every shard write above has
+        # succeeded - a crash mid-migration must leave it intact
+        os.remove(legacy_path)
+    return data
+
+
+# In-memory XP database - loaded once at startup, mutated in place by the
+# event handlers, and flushed to disk periodically instead of on every event
+DATA = load_data()
+
+# (guild_id, user_id) pairs mutated since the last flush - the flush loop
+# skips the write entirely when nothing changed during the window
+DIRTY = set()
+
+
+def mark_dirty(guild_id, user_id):
+    """Record that a user's data changed and needs a flush to disk"""
+    DIRTY.add((str(guild_id), str(user_id)))
+
+
+def flush_dirty_guilds(sync=False):
+    """Write out every guild shard touched since the last flush"""
+    pending = set(DIRTY)
+    DIRTY.clear()
+    written = set()
+    try:
+        for guild_id in {guild_id for guild_id, _ in pending}:
+            save_guild(guild_id, DATA.get(guild_id, {}), sync=sync)
+            written.add(guild_id)
+    except:
+        # Put the unwritten changes back so a later flush (or the
+        # shutdown flush) retries them instead of losing them
+        DIRTY.update(pair for pair in pending if pair[0] not in written)
+        raise
+
+
+@tasks.loop(seconds=CFG.flush_interval)
+async def flush_data():
+    """Periodically write the in-memory data to disk if anything changed"""
+    if not DIRTY:
+        return
+    pending = set(DIRTY)
+    DIRTY.clear()
+
+    # Snapshot on the event loop, then serialize and write in a worker
+    # thread so handlers keep running while the disk is busy. Taking the
+    # guild lock keeps a snapshot from landing mid-mutation.
+    shards = []
+    for guild_id in {guild_id for guild_id, _ in pending}:
+        async with _guild_locks[int(guild_id)]:
+            shards.append((guild_id, _pack_users(DATA.get(guild_id, {}))))
+
+    written = set()
+    try:
+        for guild_id, plain in shards:
+            await asyncio.to_thread(_write_shard, guild_id, plain)
+            written.add(guild_id)
+    except:
+        # Re-dirty whatever didn't make it to disk so the next cycle (or
+        # the shutdown flush) retries it instead of dropping the changes
+        DIRTY.update(pair for pair in pending if pair[0] not in written)
+        raise
+
+
+def _flush_on_exit():
+    """Make sure unsaved XP isn't lost on shutdown"""
+    if DIRTY:
+        flush_dirty_guilds(sync=True)
+
+
+@tasks.loop(minutes=10)
+async def gc_cooldowns():
+    """Sweep long-expired message cooldowns so the dict doesn't grow forever"""
+    cutoff = time.monotonic_ns() - MESSAGE_COOLDOWN_NS * 10
+    stale = [key for key, stamp in message_cooldowns.items() if stamp < cutoff]
+    for key in stale:
+        del message_cooldowns[key]
+
 
+atexit.register(_flush_on_exit)
 
-def save_data(data):
-    """Save XP data to JSON file"""
-    with open(DB_FILE, 'w') as f:
-        json.dump(data, f, indent=4)
+# Per-guild index of (xp, user_id) pairs kept in sync with DATA on every
+# XP change - rank lookups become O(log N) instead of a full sort per command
+_rank_index = defaultdict(SortedList)
+
+for _gid, _users in DATA.items():
+    _rank_index[_gid] = SortedList((u.xp, _uid) for _uid, u in _users.items())
+
+
+def update_rank_index(guild_id, user_id, old_xp, new_xp):
+    """Keep the per-guild rank index in sync after an XP change"""
+    sl = _rank_index[str(guild_id)]
+    user_id = str(user_id)
+    try:
+        sl.remove((old_xp, user_id))
+    except ValueError:
+        pass
+    sl.add((new_xp, user_id))
+
+
+def get_rank(guild_id, user_id, xp):
+    """Return a user's 1-based rank in the guild (highest XP first)"""
+    sl = _rank_index[str(guild_id)]
+    return len(sl) - sl.bisect_left((xp, str(user_id))) if sl else 0
 
 
 def get_user_data(data, guild_id, user_id, username=None):
@@ -89,46 +347,50 @@ def get_user_data(data, guild_id, user_id, username=None):
         data[guild_id] = {}
 
     if user_id not in data[guild_id]:
-        data[guild_id][user_id] = {
-            'username': username or 'Unknown',
-            'xp': 0,
-            'level': 1,
-            'messages': 0,
-            'reactions': 0,
-            'vc_seconds': 0,
-            'vc_partners': {},  # Track time with each voice channel partner
-            'longest_session': 0,  # Longest single VC session in seconds
-            'longest_session_date': None  # When the longest session occurred
-        }
-    else:
-        # Update username if provided (in case user changed their name)
-        if username:
-            data[guild_id][user_id]['username'] = username
+        _rank_index[guild_id].add((0, user_id))
+        data[guild_id][user_id] = UserData(username=username or 'Unknown')
+    elif username and data[guild_id][user_id].username != username:
+        # Refresh the stored name only when it actually changed
+        data[guild_id][user_id].username = username
 
-        # Ensure vc_partners exists for existing users
-        if 'vc_partners' not in data[guild_id][user_id]:
-            data[guild_id][user_id]['vc_partners'] = {}
+    return data[guild_id][user_id]
 
-        # Ensure longest_session fields exist for existing users
-        if 'longest_session' not in data[guild_id][user_id]:
-            data[guild_id][user_id]['longest_session'] = 0
-        if 'longest_session_date' not in data[guild_id][user_id]:
-            data[guild_id][user_id]['longest_session_date'] = None
 
-    return data[guild_id][user_id]
+# Level L starts at (L-1)^2 * 100 XP; precomputing the thresholds turns the
+# per-event level calculation into a binary search over integers
+MAX_LEVEL = 1000
+THRESHOLDS = [n * n * 100 for n in range(MAX_LEVEL)]
 
 
 def calculate_level(xp):
     """Calculate level based on XP (simple formula: level = sqrt(xp/100))"""
-    import math
-    return int(math.sqrt(xp / 100)) + 1
+    if xp < THRESHOLDS[-1]:
+        return bisect_right(THRESHOLDS, xp)
+    return isqrt(xp // 100) + 1
 
 
 def xp_for_next_level(level):
     """Calculate XP needed for next level"""
+    if 0 <= level < MAX_LEVEL:
+        return THRESHOLDS[level]
     return (level ** 2) * 100
 
 
+def grant_xp(user_data, amount):
+    """Add XP, recomputing the level only if a threshold was crossed
+
+    XP only ever increases here, so one compare against the next level's
+    threshold skips the level math on almost every grant. Returns True
+    when the user levelled up.
+    """
+    user_data.xp += amount
+    if user_data.xp >= xp_for_next_level(user_data.level):
+        user_data.level = calculate_level(user_data.xp)
+        return True
+    return False
+
+
+@lru_cache(maxsize=4096)
 def format_time(seconds):
     """Format seconds into human-readable time string"""
     hours = seconds // 3600
@@ -143,25 +405,109 @@ def format_time(seconds):
         return f"{secs}s"
 
 
+# Resolved level-up channel per guild - saves a channel lookup and a full
+# permission resolution on every level-up. None means "no usable channel".
+_levelup_channel_cache = {}
+
+# First writable fallback channel per guild, so the last-resort scan over
+# every text channel only happens once per guild
+_fallback_channel_cache = {}  # guild_id -> channel_id
+
+# Cached "can the bot send here?" flags keyed by channel id - permissions_for
+# walks every overwrite on the channel, so don't recompute it per level-up
+_can_send_cache = {}
+
+
+def _can_send(channel, guild):
+    """Check (and cache) whether the bot can send messages in a channel"""
+    allowed = _can_send_cache.get(channel.id)
+    if allowed is None:
+        allowed = channel.permissions_for(guild.me).send_messages
+        _can_send_cache[channel.id] = allowed
+    return allowed
+
+
+def _resolve_levelup_channel(guild):
+    """Resolve and cache the configured level-up channel for a guild"""
+    channel = None
+    if LEVELUP_CHANNEL_ID:
+        channel = guild.get_channel(LEVELUP_CHANNEL_ID)
+        if channel and not _can_send(channel, guild):
+            channel = None
+    _levelup_channel_cache[guild.id] = channel
+    return channel
+
+
+# Level-up announcements go through a bounded queue drained by a small
+# pool of workers, so XP handlers never wait on the Discord API and a
+# rate-limited send only stalls one worker, not the whole queue
+LEVELUP_QUEUE = asyncio.Queue(maxsize=1000)
+LEVELUP_WORKERS = 4
+_levelup_worker_tasks = []
+
+
+def queue_levelup(guild, member, level, context_channel=None):
+    """Queue a level-up announcement; drops it if the queue is full"""
+    try:
+        LEVELUP_QUEUE.put_nowait((guild, member, level, context_channel))
+    except asyncio.QueueFull:
+        print("Level-up queue full - dropping announcement")
+
+
+async def _levelup_worker():
+    """Drain the level-up queue and send the announcements"""
+    while True:
+        guild, member, level, context_channel = await LEVELUP_QUEUE.get()
+        try:
+            await send_levelup_message(guild, member, level, context_channel)
+        except discord.HTTPException:
+            pass
+        finally:
+            LEVELUP_QUEUE.task_done()
+
+
+# Static part of the announcement per level, built once - only the mention
+# differs between users hitting the same level
+_level_msg_cache = {}
+
+
+def _level_msg(level):
+    msg = _level_msg_cache.get(level)
+    if msg is None:
+        msg = _level_msg_cache[level] = f" leveled up to **Level {level}**!"
+    return msg
+
+
 async def send_levelup_message(guild, member, level, context_channel=None):
     """Send level-up message to configured channel or fallback to context channel"""
-    message = f"🎉 {member.mention} leveled up to **Level {level}**!"
+    message = f"🎉 {member.mention}{_level_msg(level)}"
 
     # Try to send to configured channel first
     if LEVELUP_CHANNEL_ID:
-        channel = guild.get_channel(LEVELUP_CHANNEL_ID)
-        if channel and channel.permissions_for(guild.me).send_messages:
+        if guild.id in _levelup_channel_cache:
+            channel = _levelup_channel_cache[guild.id]
+        else:
+            channel = _resolve_levelup_channel(guild)
+        if channel:
             await channel.send(message)
             return
 
     # Fallback to context channel if provided
-    if context_channel and context_channel.permissions_for(guild.me).send_messages:
+    if context_channel and _can_send(context_channel, guild):
         await context_channel.send(message)
         return
 
-    # Last resort: find any channel we can send to
+    # Last resort: find any channel we can send to (scanned once per guild)
+    channel_id = _fallback_channel_cache.get(guild.id)
+    if channel_id:
+        channel = guild.get_channel(channel_id)
+        if channel and _can_send(channel, guild):
+            await channel.send(message)
+            return
+
     for channel in guild.text_channels:
-        if channel.permissions_for(guild.me).send_messages:
+        if _can_send(channel, guild):
+            _fallback_channel_cache[guild.id] = channel.id
             await channel.send(message)
             break
 
@@ -179,52 +525,81 @@ async def on_ready():
 
     # Initialize voice_join_times for users already in voice channels
     for guild in bot.guilds:
+        _resolve_levelup_channel(guild)
         for voice_channel in guild.voice_channels:
             for member in voice_channel.members:
                 if not member.bot:
-                    user_key = f"{guild.id}_{member.id}"
-                    voice_join_times[user_key] = datetime.now()
-                    voice_session_starts[user_key] = datetime.now()
+                    user_key = (guild.id, member.id)
+                    now = time.monotonic()
+                    voice_join_times[user_key] = now
+                    voice_session_starts[user_key] = now
+
+    if not _levelup_worker_tasks:
+        for _ in range(LEVELUP_WORKERS):
+            _levelup_worker_tasks.append(bot.loop.create_task(_levelup_worker()))
 
     check_voice_xp.start()
+    flush_data.start()
+    gc_cooldowns.start()
+
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    """Drop cached channel info when permissions/settings may have changed"""
+    _levelup_channel_cache.pop(after.guild.id, None)
+    _fallback_channel_cache.pop(after.guild.id, None)
+    _can_send_cache.pop(after.id, None)
+
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    """Drop cached channel info when a channel goes away"""
+    _levelup_channel_cache.pop(channel.guild.id, None)
+    _fallback_channel_cache.pop(channel.guild.id, None)
+    _can_send_cache.pop(channel.id, None)
 
 
 @bot.event
 async def on_message(message):
     """Award XP for messages"""
+    # Remember the author (bots included) for the reaction handler
+    remember_message_author(message)
+
     # Ignore bot messages
     if message.author.bot:
+        return
+
+    # Commands go straight to the parser and earn no XP; plain chatter -
+    # the vast majority of messages - never pays for prefix/context parsing
+    if message.content.startswith(bot.command_prefix):
         await bot.process_commands(message)
         return
 
     # Check cooldown
-    user_key = f"{message.guild.id}_{message.author.id}"
-    current_time = datetime.now()
+    user_key = (message.guild.id, message.author.id)
+    now_ns = time.monotonic_ns()
 
-    if user_key in message_cooldowns:
-        if current_time - message_cooldowns[user_key] < timedelta(seconds=MESSAGE_COOLDOWN):
-            await bot.process_commands(message)
-            return
+    last_ns = message_cooldowns.get(user_key)
+    if last_ns is not None and now_ns - last_ns < MESSAGE_COOLDOWN_NS:
+        return
 
     # Update cooldown
-    message_cooldowns[user_key] = current_time
+    message_cooldowns[user_key] = now_ns
 
-    # Load data and award XP
-    data = load_data()
-    user_data = get_user_data(data, message.guild.id, message.author.id, str(message.author))
+    # Award XP
+    async with _guild_locks[message.guild.id]:
+        user_data = get_user_data(DATA, message.guild.id, message.author.id, message.author.name)
 
-    old_level = user_data['level']
-    user_data['xp'] += XP_PER_MESSAGE
-    user_data['messages'] += 1
-    user_data['level'] = calculate_level(user_data['xp'])
+        old_xp = user_data.xp
+        leveled_up = grant_xp(user_data, CFG.xp_per_message)
+        user_data.messages += 1
 
-    save_data(data)
+        update_rank_index(message.guild.id, message.author.id, old_xp, user_data.xp)
+        mark_dirty(message.guild.id, message.author.id)
 
     # Check for level up
-    if user_data['level'] > old_level:
-        await send_levelup_message(message.guild, message.author, user_data['level'], message.channel)
-
-    await bot.process_commands(message)
+    if leveled_up:
+        queue_levelup(message.guild, message.author, user_data.level, message.channel)
 
 
 @bot.event
@@ -244,47 +619,61 @@ async def on_raw_reaction_add(payload):
     if not channel:
         return
 
-    # Fetch the message
-    try:
-        message = await channel.fetch_message(payload.message_id)
-    except discord.NotFound:
-        return
-    except discord.Forbidden:
-        return
-    except discord.HTTPException:
-        return
-
     # Get the user who reacted
     user = payload.member
 
-    # Load data
-    data = load_data()
-
-    # Award XP to the person who added the reaction
-    user_data = get_user_data(data, guild.id, user.id, str(user))
+    # Award XP to the person who added the reaction - this needs nothing
+    # beyond the payload, so it happens before any message fetch
+    async with _guild_locks[guild.id]:
+        user_data = get_user_data(DATA, guild.id, user.id, user.name)
 
-    old_level = user_data['level']
-    user_data['xp'] += XP_PER_REACTION
-    user_data['reactions'] += 1
-    user_data['level'] = calculate_level(user_data['xp'])
+        old_xp = user_data.xp
+        leveled_up = grant_xp(user_data, CFG.xp_per_reaction)
+        user_data.reactions += 1
+        update_rank_index(guild.id, user.id, old_xp, user_data.xp)
+        mark_dirty(guild.id, user.id)
 
     # Check for level up for the person who reacted
-    if user_data['level'] > old_level:
-        await send_levelup_message(guild, user, user_data['level'], channel)
+    if leveled_up:
+        queue_levelup(guild, user, user_data.level, channel)
+
+    # Award XP to the message author (if they're not a bot and not reacting
+    # to their own message). Newer discord.py payloads carry the author id,
+    # so the REST fetch only happens when we can't resolve the author locally.
+    author_id = getattr(payload, 'message_author_id', None)
+    if author_id is None:
+        cached = _msg_authors.get(payload.message_id)
+        if cached:
+            author_id, author_is_bot = cached
+            if author_is_bot:
+                return
+    if author_id == user.id:
+        return
+
+    author = guild.get_member(author_id) if author_id else None
+    if author is None:
+        try:
+            message = await channel.fetch_message(payload.message_id)
+        except discord.NotFound:
+            return
+        except discord.Forbidden:
+            return
+        except discord.HTTPException:
+            return
+        author = message.author
 
-    # Award XP to the message author (if they're not a bot and not reacting to their own message)
-    if not message.author.bot and message.author.id != user.id:
-        author_data = get_user_data(data, guild.id, message.author.id, str(message.author))
+    if not author.bot and author.id != user.id:
+        async with _guild_locks[guild.id]:
+            author_data = get_user_data(DATA, guild.id, author.id, author.name)
 
-        old_author_level = author_data['level']
-        author_data['xp'] += XP_PER_REACTION
-        author_data['level'] = calculate_level(author_data['xp'])
+            old_author_xp = author_data.xp
+            author_leveled_up = grant_xp(author_data, CFG.xp_per_reaction)
+            update_rank_index(guild.id, author.id, old_author_xp, author_data.xp)
+            mark_dirty(guild.id, author.id)
 
         # Check for level up for the message author
-        if author_data['level'] > old_author_level:
-            await send_levelup_message(guild, message.author, author_data['level'], channel)
-
-    save_data(data)
+        if author_leveled_up:
+            queue_levelup(guild, author, author_data.level, channel)
 
 
 @bot.event
@@ -293,28 +682,29 @@ async def on_voice_state_update(member, before, after):
     if member.bot:
         return
 
-    user_key = f"{member.guild.id}_{member.id}"
+    user_key = (member.guild.id, member.id)
 
     # User joined a voice channel
     if before.channel is None and after.channel is not None:
-        voice_join_times[user_key] = datetime.now()
-        voice_session_starts[user_key] = datetime.now()
+        now = time.monotonic()
+        voice_join_times[user_key] = now
+        voice_session_starts[user_key] = now
 
     # User left a voice channel
     elif before.channel is not None and after.channel is None:
         if user_key in voice_session_starts:
             # Calculate session duration
-            session_duration = int((datetime.now() - voice_session_starts[user_key]).total_seconds())
+            session_duration = int(time.monotonic() - voice_session_starts[user_key])
 
-            # Load data and update longest session if needed
-            data = load_data()
-            user_data = get_user_data(data, member.guild.id, member.id, str(member))
+            # Update longest session if needed
+            async with _guild_locks[member.guild.id]:
+                user_data = get_user_data(DATA, member.guild.id, member.id, member.name)
 
-            # Check if this session is longer than the current record
-            if session_duration > user_data['longest_session']:
-                user_data['longest_session'] = session_duration
-                user_data['longest_session_date'] = datetime.now().isoformat()
-                save_data(data)
+                # Check if this session is longer than the current record
+                if session_duration > user_data.longest_session:
+                    user_data.longest_session = session_duration
+                    user_data.longest_session_date = datetime.now().isoformat()
+                    mark_dirty(member.guild.id, member.id)
 
             # Clean up tracking
             del voice_session_starts[user_key]
@@ -326,46 +716,94 @@ async def on_voice_state_update(member, before, after):
 @tasks.loop(minutes=1)
 async def check_voice_xp():
     """Periodically award XP to users currently in voice channels and track partner time"""
-    data = load_data()
-
-    for guild in bot.guilds:
-        for voice_channel in guild.voice_channels:
-            # Count non-bot, non-muted members in the channel
-            non_bot_members = [m for m in voice_channel.members if
-                               not m.bot and not m.voice.self_mute and not m.voice.mute]
+    # Nobody in voice anywhere - don't even walk the guilds
+    if not voice_join_times:
+        return
 
-            # Skip if only one person (or no one) is in the channel
-            if len(non_bot_members) <= 1:
-                continue
+    # voice_join_times enumerates exactly who is being tracked, so find the
+    # occupied channels through it instead of scanning every voice channel
+    # of every guild the bot is in
+    channels = set()
+    for guild_id, user_id in list(voice_join_times):
+        guild = bot.get_guild(guild_id)
+        member = guild.get_member(user_id) if guild else None
+        voice = member.voice if member else None
+        if voice and voice.channel:
+            channels.add(voice.channel)
+
+    # Work out which channels are worth crediting, then apply all mutations
+    # in one pass so the hot loop only touches the in-memory data
+    pending = []
+    for voice_channel in channels:
+        # Cheap length check before paying for the filter comprehension
+        if len(voice_channel.members) < 2:
+            continue
+
+        guild = voice_channel.guild
+
+        # Count non-bot, non-muted members in the channel
+        non_bot_members = [m for m in voice_channel.members if
+                           not m.bot and not m.voice.self_mute and not m.voice.mute]
+
+        # Skip if only one person (or no one) is in the channel
+        if len(non_bot_members) <= 1:
+            continue
+
+        eligible = [m for m in non_bot_members if (guild.id, m.id) in voice_join_times]
+        if eligible:
+            pending.append((guild, non_bot_members, eligible))
+
+    for guild, channel_members, eligible in pending:
+        async with _guild_locks[guild.id]:
+            await _apply_voice_tick(guild, channel_members, eligible)
+
+
+async def _apply_voice_tick(guild, channel_members, eligible):
+    """Apply one minute of voice XP and partner time for one channel"""
+    guild_data = DATA.setdefault(str(guild.id), {})
+
+    # Build each member's strings once per tick instead of once per pair
+    names = {m.id: m.name for m in channel_members}
+    ids = {m.id: str(m.id) for m in channel_members}
+
+    def get_record(m):
+        """Fetch a member's record, creating it on first sight"""
+        rec = guild_data.get(ids[m.id])
+        if rec is None:
+            rec = get_user_data(DATA, guild.id, m.id, names[m.id])
+        return rec
+
+    def credit_partner(rec, partner_id, partner_name):
+        """Add one minute to a member's time with one partner"""
+        entry = rec.vc_partners.get(partner_id)
+        if entry is None:
+            rec.vc_partners[partner_id] = {'username': partner_name, 'seconds': 60}
+        else:
+            if entry['username'] != partner_name:
+                entry['username'] = partner_name
+            entry['seconds'] += 60
 
-            for member in non_bot_members:
-                user_key = f"{guild.id}_{member.id}"
-                if user_key in voice_join_times:
-                    # Award XP for 1 minute (60 seconds)
-                    user_data = get_user_data(data, guild.id, member.id, str(member))
-                    old_level = user_data['level']
+    for member in eligible:
+        # Award XP for 1 minute (60 seconds)
+        user_data = get_record(member)
+        old_xp = user_data.xp
 
-                    user_data['xp'] += XP_PER_MINUTE_VC
-                    user_data['vc_seconds'] += 60
-                    user_data['level'] = calculate_level(user_data['xp'])
+        leveled_up = grant_xp(user_data, CFG.xp_per_minute_vc)
+        user_data.vc_seconds += 60
+        update_rank_index(guild.id, member.id, old_xp, user_data.xp)
 
-                    # Track time with each partner in the voice channel
-                    for partner in non_bot_members:
-                        if partner.id != member.id:  # Don't track time with yourself
-                            partner_id = str(partner.id)
-                            if partner_id not in user_data['vc_partners']:
-                                user_data['vc_partners'][partner_id] = {
-                                    'username': str(partner),
-                                    'seconds': 0
-                                }
-                            user_data['vc_partners'][partner_id]['seconds'] += 60
-                            user_data['vc_partners'][partner_id]['username'] = str(partner)  # Update username
+        # Check for level up
+        if leveled_up:
+            queue_levelup(guild, member, user_data.level)
 
-                    # Check for level up
-                    if user_data['level'] > old_level:
-                        await send_levelup_message(guild, member, user_data['level'])
+    # Partner time is symmetric, so walk each unordered pair once and
+    # credit both sides - half the updates of the old nested loop
+    for a, b in combinations(channel_members, 2):
+        credit_partner(get_record(a), ids[b.id], names[b.id])
+        credit_partner(get_record(b), ids[a.id], names[a.id])
 
-    save_data(data)
+    for member in channel_members:
+        mark_dirty(guild.id, member.id)
 
 
 @bot.command(name='rank')
@@ -373,35 +811,38 @@ async def rank(ctx, member: discord.Member = None):
     """Check your or someone else's rank"""
     member = member or ctx.author
 
-    data = load_data()
-    user_data = get_user_data(data, ctx.guild.id, member.id)
+    # Read-only lookup - don't create a blank record (and a rank index
+    # entry) just because someone checked an inactive user
+    user_data = DATA.get(str(ctx.guild.id), {}).get(str(member.id))
+    if user_data is None:
+        await ctx.send(f"{member.display_name} hasn't earned any XP yet!")
+        return
 
     # Calculate rank
-    guild_data = data.get(str(ctx.guild.id), {})
-    sorted_users = sorted(guild_data.items(), key=lambda x: x[1]['xp'], reverse=True)
-    rank = next((i + 1 for i, (uid, _) in enumerate(sorted_users) if uid == str(member.id)), 0)
+    rank = get_rank(ctx.guild.id, member.id, user_data.xp)
 
     # Calculate XP for next level
-    next_level_xp = xp_for_next_level(user_data['level'])
-    xp_progress = user_data['xp'] - xp_for_next_level(user_data['level'] - 1)
-    xp_needed = next_level_xp - xp_for_next_level(user_data['level'] - 1)
+    next_level_xp = xp_for_next_level(user_data.level)
+    prev_level_xp = xp_for_next_level(user_data.level - 1)
+    xp_progress = user_data.xp - prev_level_xp
+    xp_needed = next_level_xp - prev_level_xp
 
     embed = discord.Embed(title=f"📊 {member.display_name}'s Stats", color=discord.Color.blue())
     embed.set_thumbnail(url=member.display_avatar.url)
     embed.add_field(name="Rank", value=f"#{rank}", inline=True)
-    embed.add_field(name="Level", value=user_data['level'], inline=True)
-    embed.add_field(name="Total XP", value=f"{user_data['xp']:,}", inline=True)
-    embed.add_field(name="Progress", value=f"{xp_progress}/{xp_needed} XP to Level {user_data['level'] + 1}",
+    embed.add_field(name="Level", value=user_data.level, inline=True)
+    embed.add_field(name="Total XP", value=f"{user_data.xp:,}", inline=True)
+    embed.add_field(name="Progress", value=f"{xp_progress}/{xp_needed} XP to Level {user_data.level + 1}",
                     inline=False)
-    embed.add_field(name="Messages", value=user_data['messages'], inline=True)
-    embed.add_field(name="Reactions", value=user_data['reactions'], inline=True)
+    embed.add_field(name="Messages", value=user_data.messages, inline=True)
+    embed.add_field(name="Reactions", value=user_data.reactions, inline=True)
 
     # Format VC time
-    vc_time_str = format_time(user_data.get('vc_seconds', 0))
+    vc_time_str = format_time(user_data.vc_seconds)
     embed.add_field(name="VC Time", value=vc_time_str, inline=True)
 
     # Add longest session info
-    longest_session = user_data.get('longest_session', 0)
+    longest_session = user_data.longest_session
     if longest_session > 0:
         longest_str = format_time(longest_session)
         embed.add_field(name="🏆 Longest Session", value=longest_str, inline=True)
@@ -414,10 +855,10 @@ async def vc_partners(ctx, member: discord.Member = None):
     """Show who you've spent the most time with in voice channels"""
     member = member or ctx.author
 
-    data = load_data()
-    user_data = get_user_data(data, ctx.guild.id, member.id)
+    # Read-only lookup, same as rank - no record is created here
+    user_data = DATA.get(str(ctx.guild.id), {}).get(str(member.id))
 
-    vc_partners = user_data.get('vc_partners', {})
+    vc_partners = user_data.vc_partners if user_data else None
 
     if not vc_partners:
         await ctx.send(f"{member.display_name} hasn't spent time in voice channels with anyone yet!")
@@ -437,11 +878,17 @@ async def vc_partners(ctx, member: discord.Member = None):
     for i, (partner_id, partner_data) in enumerate(sorted_partners[:10], 1):
         time_str = format_time(partner_data['seconds'])
 
-        # Try to get the actual member for display name
-        try:
-            partner_member = await ctx.guild.fetch_member(int(partner_id))
+        # Try to get the actual member for display name - cache first, the
+        # HTTP fetch only on a miss
+        partner_member = ctx.guild.get_member(int(partner_id))
+        if partner_member is None:
+            try:
+                partner_member = await ctx.guild.fetch_member(int(partner_id))
+            except:
+                partner_member = None
+        if partner_member:
             partner_name = partner_member.display_name
-        except:
+        else:
             partner_name = partner_data.get('username', f'User {partner_id}')
 
         medal = ""
@@ -465,6 +912,23 @@ async def vc_partners(ctx, member: discord.Member = None):
     await ctx.send(embed=embed)
 
 
+# Leaderboard categories: name -> (record attribute, embed title, stat label).
+# Module-level so the command doesn't rebuild the dict per invocation.
+VALID_CATEGORIES = {
+    'xp': ('xp', '🏆 XP', 'XP'),
+    'level': ('level', '⭐ Level', 'Level'),
+    'messages': ('messages', '💬 Messages', 'Messages'),
+    'reactions': ('reactions', '❤️ Reactions', 'Reactions'),
+    'vc': ('vc_seconds', '🎙️ Voice Time', 'Time'),
+    'vctime': ('vc_seconds', '🎙️ Voice Time', 'Time'),
+    'voice': ('vc_seconds', '🎙️ Voice Time', 'Time'),
+    'session': ('longest_session', '⏱️ Longest Session', 'Session'),
+    'longest': ('longest_session', '⏱️ Longest Session', 'Session')
+}
+
+INVALID_CATEGORY_MSG = "❌ Invalid category! Use: `xp`, `level`, `messages`, `reactions`, `vc`, or `session`"
+
+
 @bot.command(name='leaderboard')
 async def leaderboard(ctx, category: str = 'xp', page: int = 1):
     """Show the server leaderboard
@@ -473,43 +937,38 @@ async def leaderboard(ctx, category: str = 'xp', page: int = 1):
     Usage: !leaderboard [category] [page]
     Example: !leaderboard session 1
     """
-    data = load_data()
-    guild_data = data.get(str(ctx.guild.id), {})
+    guild_data = DATA.get(str(ctx.guild.id), {})
 
     if not guild_data:
         await ctx.send("No XP data available yet!")
         return
 
     # Validate and normalize category
-    category = category.lower()
-    valid_categories = {
-        'xp': ('xp', '🏆 XP', 'XP'),
-        'level': ('level', '⭐ Level', 'Level'),
-        'messages': ('messages', '💬 Messages', 'Messages'),
-        'reactions': ('reactions', '❤️ Reactions', 'Reactions'),
-        'vc': ('vc_seconds', '🎙️ Voice Time', 'Time'),
-        'vctime': ('vc_seconds', '🎙️ Voice Time', 'Time'),
-        'voice': ('vc_seconds', '🎙️ Voice Time', 'Time'),
-        'session': ('longest_session', '⏱️ Longest Session', 'Session'),
-        'longest': ('longest_session', '⏱️ Longest Session', 'Session')
-    }
-
-    if category not in valid_categories:
-        await ctx.send(f"❌ Invalid category! Use: `xp`, `level`, `messages`, `reactions`, `vc`, or `session`")
+    entry = VALID_CATEGORIES.get(category.lower())
+    if entry is None:
+        await ctx.send(INVALID_CATEGORY_MSG)
         return
 
-    sort_key, title_emoji, stat_name = valid_categories[category]
-
-    # Sort by selected category
-    sorted_users = sorted(guild_data.items(), key=lambda x: x[1].get(sort_key, 0), reverse=True)
+    sort_key, title_emoji, stat_name = entry
 
     # Pagination
     per_page = 10
-    total_pages = (len(sorted_users) + per_page - 1) // per_page
+    total_users = len(guild_data)
+    total_pages = (total_users + per_page - 1) // per_page
     page = max(1, min(page, total_pages))
 
     start_idx = (page - 1) * per_page
-    end_idx = start_idx + per_page
+    end_idx = min(start_idx + per_page, total_users)
+
+    if sort_key == 'xp':
+        # The rank index is already sorted - slice the page straight out of
+        # it instead of re-sorting the whole guild
+        sl = _rank_index[str(ctx.guild.id)]
+        page_entries = [(uid, guild_data[uid]) for _, uid in
+                        reversed(list(sl.islice(total_users - end_idx, total_users - start_idx)))]
+    else:
+        sorted_users = sorted(guild_data.items(), key=lambda x: getattr(x[1], sort_key), reverse=True)
+        page_entries = sorted_users[start_idx:end_idx]
 
     embed = discord.Embed(
         title=f"{title_emoji} Leaderboard - {ctx.guild.name}",
@@ -517,12 +976,27 @@ async def leaderboard(ctx, category: str = 'xp', page: int = 1):
         color=discord.Color.gold()
     )
 
-    for i, (user_id, user_data) in enumerate(sorted_users[start_idx:end_idx], start=start_idx + 1):
+    # Resolve the page's members in one pass: cache hits are free, and any
+    # misses go out as a single gateway query instead of one REST fetch per row
+    members = {}
+    missing = []
+    for user_id, _ in page_entries:
+        uid = int(user_id)
+        member = ctx.guild.get_member(uid)
+        if member:
+            members[uid] = member
+        else:
+            missing.append(uid)
+    if missing:
         try:
-            member = await ctx.guild.fetch_member(int(user_id))
-            name = member.display_name
+            for m in await ctx.guild.query_members(user_ids=missing):
+                members[m.id] = m
         except:
-            name = user_data.get('username', f"User {user_id}")
+            pass
+
+    for i, (user_id, user_data) in enumerate(page_entries, start=start_idx + 1):
+        member = members.get(int(user_id))
+        name = member.display_name if member else user_data.username
 
         medal = ""
         if i == 1:
@@ -533,16 +1007,16 @@ async def leaderboard(ctx, category: str = 'xp', page: int = 1):
             medal = "🥉 "
 
         # Format the stat value based on category
-        stat_value = user_data.get(sort_key, 0)
+        stat_value = getattr(user_data, sort_key)
 
         if sort_key in ['vc_seconds', 'longest_session']:
             # Format time
             formatted_stat = format_time(stat_value)
-            value_text = f"{formatted_stat} • Level {user_data['level']}"
+            value_text = f"{formatted_stat} • Level {user_data.level}"
         else:
             # Format numbers with commas
             formatted_stat = f"{stat_value:,}"
-            value_text = f"{formatted_stat} {stat_name} • Level {user_data['level']}"
+            value_text = f"{formatted_stat} {stat_name} • Level {user_data.level}"
 
         embed.add_field(
             name=f"{medal}#{i} {name}",
@@ -562,10 +1036,10 @@ async def xp_config(ctx):
     """Show current XP configuration (Admin only)"""
     embed = discord.Embed(title="⚙️ XP Configuration", color=discord.Color.green())
     embed.add_field(name="Bot Version", value=BOT_VERSION, inline=True)
-    embed.add_field(name="XP per Message", value=XP_PER_MESSAGE, inline=True)
-    embed.add_field(name="XP per Reaction", value=XP_PER_REACTION, inline=True)
-    embed.add_field(name="XP per VC Minute", value=XP_PER_MINUTE_VC, inline=True)
-    embed.add_field(name="Message Cooldown", value=f"{MESSAGE_COOLDOWN}s", inline=True)
+    embed.add_field(name="XP per Message", value=CFG.xp_per_message, inline=True)
+    embed.add_field(name="XP per Reaction", value=CFG.xp_per_reaction, inline=True)
+    embed.add_field(name="XP per VC Minute", value=CFG.xp_per_minute_vc, inline=True)
+    embed.add_field(name="Message Cooldown", value=f"{CFG.message_cooldown}s", inline=True)
 
     if LEVELUP_CHANNEL_ID:
         channel = ctx.guild.get_channel(LEVELUP_CHANNEL_ID)
@@ -581,13 +1055,18 @@ async def xp_config(ctx):
 @commands.has_permissions(administrator=True)
 async def reset_xp(ctx, member: discord.Member):
     """Reset a user's XP (Admin only)"""
-    data = load_data()
     guild_id = str(ctx.guild.id)
     user_id = str(member.id)
 
-    if guild_id in data and user_id in data[guild_id]:
-        del data[guild_id][user_id]
-        save_data(data)
+    if guild_id in DATA and user_id in DATA[guild_id]:
+        async with _guild_locks[ctx.guild.id]:
+            old_xp = DATA[guild_id][user_id].xp
+            del DATA[guild_id][user_id]
+            try:
+                _rank_index[guild_id].remove((old_xp, user_id))
+            except ValueError:
+                pass
+            mark_dirty(guild_id, user_id)
         await ctx.send(f"✅ Reset XP for {member.display_name}")
     else:
         await ctx.send(f"❌ No XP data found for {member.display_name}")